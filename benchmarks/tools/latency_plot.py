@@ -22,17 +22,28 @@ def _add_series(series, label, marker):
              markersize=4)
 
 
-def draw_plot(yscale='linear'):
-    """Draw a plot of all previously added data series"""
+def _decorate_plot(yscale):
+    """Set up plot axes, grid and legend"""
     plt.yscale(yscale)
     plt.xticks(list(range(0, 101, 5)))
     plt.xlabel('percentile [%]')
     plt.grid(True)
     plt.ylabel('operation time [ns]')
     plt.legend()
+
+
+def draw_plot(yscale='linear'):
+    """Draw a plot of all previously added data series"""
+    _decorate_plot(yscale)
     plt.show()
 
 
+def draw_plot_snapshot(path, yscale='linear'):
+    """Save a plot of all previously added data series to a file"""
+    _decorate_plot(yscale)
+    plt.savefig(path)
+
+
 def _parse_args():
     """Parse command line arguments"""
     parser = argparse.ArgumentParser()
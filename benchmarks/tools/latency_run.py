@@ -10,12 +10,26 @@ Benchmark configurations are stored in benchconfig.py file as separate
 dictionaries with names starting with 'bench_'. Configuration key 'testdir'
 is a benchmark test directory. All other keys and their values are directly
 translated into 'bench_simul' command line arguments.
+
+Benchmark processes are pinned to CPUs ('numa_node'/'cpu_list' keys) and
+the orchestrator pins itself to a single core outside that set. Unpinned
+benchmarks may be migrated between cores with unsynchronized TSCs, which
+corrupts latency samples and thrashes caches, and an unpinned orchestrator
+may steal a measurement core from a running benchmark.
 """
 
 import sys
 import os
 import argparse
+import collections
+import contextlib
+import hashlib
+import queue
+import resource
+import shlex
 import subprocess as sp
+import threading
+from concurrent import futures
 import latency_plot as lp
 
 
@@ -25,53 +39,173 @@ except ImportError:
     sys.exit('no benchconfig.py file provided')
 
 
-class Benchmark():
-    """Benchmark management"""
-    def __init__(self, bin_, cfg):
-        self.bin = bin_
-        self.cmd = ''
-        self.handle_special_keys(cfg)
-        for k, v in cfg.items():
-            self.cmd = self.cmd + ' {}={}'.format(k, v)
-        if 'latency_samples' not in cfg:
-            self.cmd = self.cmd + ' latency_samples=101'
-
-    def handle_special_keys(self, cfg):
-        """
-        Handle configuration keys that are NOT a direct
-        representations of bench_simul command line arguments
-        """
-        try:
-            self.title = cfg.pop('title')
-            cfg['latency_file'] = '{}.log'.format(self.title)
-            self.out = cfg['latency_file']
-            self.cmd = '{} {}'.format(self.bin, cfg.pop('testdir'))
-            if 'numa_node' in cfg:
-                self.cmd = 'numactl -N {} {}'.format(cfg.pop('numa_node'), self.cmd)
-        except KeyError as e:
-            sys.exit('No "{}" key provided to configuration'.format(e.args[0]))
+# number of trailing stderr lines shown when a benchmark fails
+STDERR_TAIL = 20
+
+# a partial plot is checkpointed after every that many finished benchmarks
+PLOT_CHECKPOINT = 5
+
+# file the partial plot is checkpointed to
+SNAPSHOT_FILE = 'latency_partial.png'
+
+# soft open-files limit in effect while benchmarks are spawned
+SPAWN_NOFILE = 1024
+
+
+# a single benchmark normalized into a fully resolved command line:
+# 'title' names the data series, 'out' is the latency_file the benchmark
+# writes to, 'bin' is the bench_simul binary, 'argv' is the complete
+# (immutable) command line
+BenchSpec = collections.namedtuple('BenchSpec', ['title', 'out', 'bin',
+                                                 'argv'])
+
+
+def _make_spec(bin_, cfg, default_cpus=None):
+    """
+    Normalize a single benchconfig dictionary into a BenchSpec, handling
+    the configuration keys that are NOT a direct representation of
+    bench_simul command line arguments. Raises KeyError when a required
+    key is missing.
+    """
+    cfg = dict(cfg)
+    title = cfg.pop('title')
+    out = '{}.log'.format(title)
+    cfg['latency_file'] = out
+    argv = [bin_, cfg.pop('testdir')]
+    numa_node = cfg.pop('numa_node', None)
+    cpu_list = cfg.pop('cpu_list', None)
+    membind = cfg.pop('membind', numa_node is not None)
+    if numa_node is None and cpu_list is None:
+        cpu_list = default_cpus
+    if numa_node is not None:
+        prefix = ['numactl', '-N', str(numa_node)]
+        if membind:
+            prefix += ['-m', str(numa_node)]
+        if cpu_list is not None:
+            prefix += ['-C', str(cpu_list)]
+        argv = prefix + argv
+    elif cpu_list is not None:
+        argv = ['taskset', '-c', str(cpu_list)] + argv
+    argv.extend('{}={}'.format(k, v) for k, v in cfg.items())
+    if 'latency_samples' not in cfg:
+        argv.append('latency_samples=101')
+    return BenchSpec(title, out, bin_, tuple(argv))
 
 
-    def add_to_plot(self):
-        """Add benchmark to plot"""
-        lp.add_data(self.out, self.title)
+def _pin_orchestrator():
+    """
+    Pin the orchestrator to a single core so it never steals a measurement
+    core from a running benchmark. Returns the remaining cores as a cpu_list
+    string for the children, or None when there is no core to spare.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < 2:
+        return None
+    os.sched_setaffinity(0, {cpus[0]})
+    return ','.join(str(c) for c in cpus[1:])
 
-    def run(self, verbose):
-        """Run benchmark"""
+
+def _spec_hash(spec):
+    """
+    Content hash identifying a benchmark run: its full command line and
+    the mtime of the bench_simul binary
+    """
+    ident = '{!r} {}'.format(spec.argv, os.path.getmtime(spec.bin))
+    return hashlib.sha256(ident.encode()).hexdigest()
+
+
+def _is_cached(spec, h):
+    """Check whether spec's output file is up to date"""
+    meta = spec.out + '.meta'
+    if not os.path.exists(spec.out) or not os.path.exists(meta):
+        return False
+    with open(meta) as f:
+        return f.read() == h
+
+
+def run(spec, verbose, force=False):
+    """Run a single benchmark (submitted as an executor task)"""
+    cmd = ' '.join(shlex.quote(a) for a in spec.argv)
+
+    # skip the run when its output is already there from an identical
+    # invocation - makes plot-only reruns free
+    h = _spec_hash(spec)
+    if not force and _is_cached(spec, h):
         if verbose:
-            print(self.cmd)
+            print('cached: {}'.format(cmd))
+        return
 
-        proc = sp.run(self.cmd.split(' '), universal_newlines=True,
-                      stdout=sp.PIPE, stderr=sp.STDOUT)
+    if verbose:
+        # stream the output line by line instead of buffering all of
+        # it in memory - for long runs it can grow into megabytes
+        print(cmd)
+        # close_fds=False lets the interpreter spawn through posix_spawn
+        # instead of fork+exec; the orchestrator holds nothing a benchmark
+        # should not inherit
+        with sp.Popen(spec.argv, universal_newlines=True, bufsize=1,
+                      stdout=sp.PIPE, stderr=sp.STDOUT,
+                      close_fds=False) as proc:
+            for line in proc.stdout:
+                sys.stdout.write(line)
         if proc.returncode != 0:
-            sys.exit('benchmark failed: {}{}{}'.format(self.cmd, os.linesep,
-                                                       proc.stdout))
-        if verbose:
-            print('{}{}{}'.format(self.cmd, os.linesep, proc.stdout))
+            sys.exit('benchmark failed: {}'.format(cmd))
+    else:
+        proc = sp.run(spec.argv, universal_newlines=True,
+                      stdout=sp.DEVNULL, stderr=sp.PIPE, close_fds=False)
+        if proc.returncode != 0:
+            tail = proc.stderr.splitlines()[-STDERR_TAIL:]
+            sys.exit('benchmark failed: {}{}{}'.format(
+                cmd, os.linesep, os.linesep.join(tail)))
 
+    with open(spec.out + '.meta', 'w') as f:
+        f.write(h)
 
-def parse_config():
-    """Read configurations from benchconfig.py file"""
+
+@contextlib.contextmanager
+def _spawn_rlimit():
+    """
+    Temporarily lower the soft open-files limit around the spawn batch.
+    When the interpreter cannot use posix_spawn it falls back to fork and
+    closes every descriptor up to RLIMIT_NOFILE in the child; with limits
+    in the millions that adds milliseconds to every benchmark launch.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft <= SPAWN_NOFILE:
+        yield
+        return
+    resource.setrlimit(resource.RLIMIT_NOFILE, (SPAWN_NOFILE, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def _plot_worker(q, yscale):
+    """
+    Consume finished benchmarks from the queue and add them to the plot.
+    Parsing the output files overlaps with the still-running benchmarks,
+    and a partial plot is checkpointed to SNAPSHOT_FILE every
+    PLOT_CHECKPOINT benchmarks, so a late failure does not discard the
+    runs that did finish.
+    """
+    done = 0
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        lp.add_data(*item)
+        done += 1
+        if done % PLOT_CHECKPOINT == 0:
+            lp.draw_plot_snapshot(SNAPSHOT_FILE, yscale)
+
+
+def parse_config(bin_, default_cpus=None):
+    """
+    Read configurations from benchconfig.py file and normalize them into
+    BenchSpecs. All configurations are validated up front so a broken one
+    is reported before any benchmark is started, and all invalid ones are
+    reported at once.
+    """
     cfgs = []
     for k, v in vars(benchconfig).items():
         if k.startswith('bench_') and isinstance(v, dict):
@@ -81,7 +215,34 @@ def parse_config():
     if not cfgs:
         sys.exit('No configs found in benchconfig.py - all configs should '
                  'be dictionaries starting with "bench_"')
-    return cfgs
+
+    specs = []
+    errors = []
+    for c in cfgs:
+        try:
+            specs.append(_make_spec(bin_, c, default_cpus))
+        except KeyError as e:
+            errors.append('{}: no "{}" key provided'.format(c['title'],
+                                                            e.args[0]))
+    if errors:
+        sys.exit('Invalid configurations in benchconfig.py:{}{}'.format(
+            os.linesep, os.linesep.join(errors)))
+    return specs
+
+
+def _emit_parallel(specs):
+    """Print one resolved command line per config, for GNU parallel/xargs"""
+    for s in specs:
+        print(' '.join(shlex.quote(a) for a in s.argv))
+
+
+def _emit_make(specs):
+    """Print a Makefile with one {title}.log target per config"""
+    print('all: {}'.format(' '.join(s.out for s in specs)))
+    for s in specs:
+        print()
+        print('{}: {}'.format(s.out, s.bin))
+        print('\t{}'.format(' '.join(shlex.quote(a) for a in s.argv)))
 
 
 def parse_args():
@@ -96,26 +257,86 @@ def parse_args():
                         default='linear')
     parser.add_argument('--verbose', '-v', help='Print bench_simul output',
                         action='store_true')
+    parser.add_argument('--force', '-f', help='rerun benchmarks even when '
+                        'an up-to-date output file from an identical '
+                        'invocation exists', action='store_true')
+    parser.add_argument('--jobs', '-j', help='number of benchmarks run in '
+                        'parallel (0 means the number of CPUs); parallel '
+                        'benchmarks perturb each other, so latency-sensitive '
+                        'runs should keep the default of 1',
+                        default=1, type=int)
+    parser.add_argument('--emit', choices=['parallel', 'make'],
+                        help='run nothing; print the resolved command lines '
+                        '(one per line, for GNU parallel or xargs) or a '
+                        'Makefile (one target per output file, for make -j) '
+                        'and exit - plot the results afterwards with '
+                        'latency_plot.py')
     args = parser.parse_args()
     return args
 
 
 def main():
     args = parse_args()
-    file_cfgs = parse_config()
+    # pin self and hand the remaining cores to benchmarks that do not pin
+    # themselves already; numa_node configs keep their node's core set
+    # (when emitting a job list the external driver places the jobs, so
+    # no core is reserved for the orchestrator)
+    child_cpus = None if args.emit else _pin_orchestrator()
+    file_specs = parse_config(args.bin, child_cpus)
     if args.config:
-        cfgs = [c for c in file_cfgs if c['title'] in args.config]
-        if len(args.config) != len(cfgs):
-            titles = os.linesep.join([c['title'] for c in file_cfgs])
+        specs = [s for s in file_specs if s.title in args.config]
+        if len(args.config) != len(specs):
+            titles = os.linesep.join([s.title for s in file_specs])
             sys.exit('Invalid configuration provided, configurations defined'
                      ' in benchconfig.py:{}{}'.format(os.linesep, titles))
     else:
-        cfgs = file_cfgs
+        specs = file_specs
 
-    for c in cfgs:
-        b = Benchmark(args.bin, c)
-        b.run(args.verbose)
-        b.add_to_plot()
+    if args.emit == 'parallel':
+        _emit_parallel(specs)
+        return
+    if args.emit == 'make':
+        _emit_make(specs)
+        return
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if jobs > 1 and any(s.argv[0] == 'numactl' for s in specs):
+        print('warning: benchmarks pinned with numa_node run in parallel '
+              'and will contend for the node', file=sys.stderr)
+
+    q = queue.Queue()
+    plotter = threading.Thread(target=_plot_worker, args=(q, args.yscale),
+                               daemon=True)
+    plotter.start()
+
+    # each benchmark runs in its own bench_simul process and writes to its
+    # own latency_file, so they can be launched concurrently; results are
+    # handed to the plot worker in input order to keep the plot
+    # deterministic
+    failed = None
+    done = 0
+    with _spawn_rlimit(), futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+        futs = [ex.submit(run, s, args.verbose, args.force) for s in specs]
+        for f, s in zip(futs, specs):
+            try:
+                f.result()
+            except SystemExit as e:
+                failed = e
+                for rest in futs:
+                    rest.cancel()
+                break
+            q.put((s.out, s.title))
+            done += 1
+    q.put(None)
+    plotter.join()
+
+    if failed is not None:
+        # keep the partial plot of the benchmarks that did finish
+        if done:
+            lp.draw_plot_snapshot(SNAPSHOT_FILE, args.yscale)
+            print('partial plot saved to {}'.format(SNAPSHOT_FILE),
+                  file=sys.stderr)
+        sys.exit(failed.code)
 
     lp.draw_plot(args.yscale)
 